@@ -3,17 +3,54 @@ import time
 import argparse
 import re
 import os
+import functools
+import operator
+from array import array
 
 def clear_console():
-    # Clears the terminal screen based on OS [cite: 1]
-    os.system('cls' if os.name == 'nt' else 'clear')
-
-HAVE_TOAST = False
-try:
-    from win11toast import toast as toast_fn
-    HAVE_TOAST = True
-except ImportError:
-    HAVE_TOAST = False
+    # Clears the terminal screen with an escape sequence, like the colours, instead of
+    # running cls/clear in a subprocess [cite: 1]
+    _OUT_BUF.append(_CLEAR_SCREEN)
+    _flush()
+
+# The classic Windows console only interprets escape sequences (colours, clearing)
+# once virtual terminal processing is switched on. Running cls used to do that as a
+# side effect, so it is now switched on once, before a script first runs.
+_VT_ENABLED = False
+
+def _enable_vt():
+    global _VT_ENABLED
+    if _VT_ENABLED or os.name != "nt": return
+    _VT_ENABLED = True
+    import ctypes
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+    mode = ctypes.c_uint32()
+    # Fails (and is skipped) when stdout is not a console, e.g. when redirected
+    if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+        kernel32.SetConsoleMode(handle, mode.value | 0x0004)  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+
+# The notification backend is imported on the first msg command, so scripts that
+# never notify don't pay for it at startup. None means "not checked yet".
+# win11toast is preferred; win10toast is used when only that one is installed.
+HAVE_TOAST = None
+toast_fn = None
+
+def _get_toast():
+    global HAVE_TOAST, toast_fn
+    if HAVE_TOAST is None:
+        try:
+            from win11toast import toast as toast_fn
+            HAVE_TOAST = True
+        except ImportError:
+            try:
+                from win10toast import ToastNotifier
+                notifier = ToastNotifier()
+                toast_fn = lambda title, msg: notifier.show_toast(title, msg, duration=5, threaded=True)
+                HAVE_TOAST = True
+            except ImportError:
+                HAVE_TOAST = False
+    return toast_fn
 
 COLOR_CODES = {
     "%redtext": "\033[91m",
@@ -22,207 +59,706 @@ COLOR_CODES = {
     "%purpletext": "\033[95m",
     "%normal": "\033[0m",
 }
-
-variables = {} 
+_COLOR_NAMES = frozenset(COLOR_CODES)
+_END_TOKEN = "einid cimidisiciriiipit"
+_RESET_NL = COLOR_CODES["%normal"] + "\n"  # ends every write line
+
+_RE_IF = re.compile(r"%if\s+(.+?)\s*(>=|<=|X=|=|>|<)\s*(.+)")
+_VAR_TYPES = ("%int", "%dec", "%txt", "%string")
+_RE_QUOTED = re.compile(r'"([^"]*)"')
+_RE_MSG = re.compile(r'%title\s+"([^"]+)"\s+%subtitle\s+(.+)')
+
+# Opcodes produced by compile_line; each compiled op is a tuple (OP_xxx, *args)
+(OP_WRITE, OP_WAIT, OP_MSG, OP_SEND_NL, OP_SET_VAR, OP_DECL_VAR, OP_TYPE_VAR,
+ OP_ICQ, OP_CALL, OP_END, OP_CLS, OP_IF, OP_ELSE, OP_NOP, OP_ERROR, OP_WRITE_CONST,
+ OP_JMP_IF_FALSE, OP_JMP, OP_PUSH_INPUT, OP_POP_INPUT) = range(20)
+# OP_IF/OP_ELSE/OP_NOP only exist between compile_line and _lower_block; the
+# flat code that runs contains OP_JMP_IF_FALSE (target, test, lhs, rhs) and OP_JMP (target).
+# OP_PUSH_INPUT/OP_POP_INPUT save and restore %1 around an %if/%else whose bodies
+# prompt, since %icq inside them doesn't change %1 for the code after.
+
+# Token kinds for pre-tokenized write arguments
+KIND_LITERAL, KIND_COLOR, KIND_INPUT, KIND_VAR, KIND_NAME = range(5)
+
+# Variable storage as parallel lists indexed by a per-name slot number. Names are
+# given a slot the first time the compiler sees them, and compiled ops carry the
+# number, so a read is one list index. A slot holds _UNDECLARED until %newestvar runs.
+# _var_text keeps str() of each value, updated on every store (None while undeclared),
+# since scripts read variables as text.
+_UNDECLARED = object()
+_var_index = {}
+_var_values = []
+_var_types = []
+_var_text = []
 functions = {} 
+_function_output = {}  # functions whose body only writes constant text -> that text
+_SAVED_INPUT = []  # %1 as it was before each %if/%else being run that prompts
+_pure_reads = {}  # functions whose output depends only on %1 and variables -> slots they read
+
+# Script output is collected here as encoded bytes and written in one go at sync
+# points (input, wait, clear, exit), or once _FLUSH_AT chunks have piled up so a long
+# run doesn't hold all its output. On a terminal every line is flushed so output
+# stays live. Constant text is encoded once at compile time.
+_OUT_BUF = []
+_CAPTURE = []  # what a memoized function writes while it first runs (see _pure_output)
+# Taken from sys.stdout by _bind_stdout when a script is run rather than at import:
+# stdout may have been replaced by then, or be None (pythonw)
+_FLUSH_AT = 4096
+_ENCODING = "utf-8"
+_ERRORS = "strict"
+_SPACE = _NEWLINE = _CLEAR_SCREEN = b""
+
+def _encode(text):
+    # Bytes skip the text layer, so apply its "\n" translation here as well
+    return text.replace("\n", os.linesep).encode(_ENCODING, _ERRORS)
+
+def _bind_stdout():
+    global _FLUSH_AT, _ENCODING, _ERRORS, _SPACE, _NEWLINE, _CLEAR_SCREEN
+    stdout = sys.stdout
+    _FLUSH_AT = 1 if stdout is not None and stdout.isatty() else 4096
+    _ENCODING = getattr(stdout, "encoding", None) or "utf-8"
+    _ERRORS = getattr(stdout, "errors", None) or "strict"
+    _SPACE = _encode(" ")
+    _NEWLINE = _encode("\n")
+    _CLEAR_SCREEN = _encode("\033[H\033[2J\033[3J")  # cursor home, screen, scrollback (as clear(1))
+
+def _flush():
+    stdout = sys.stdout
+    if stdout is None:
+        # Nowhere to write to, so the output is dropped
+        _OUT_BUF.clear()
+        return
+    if _OUT_BUF:
+        data = b"".join(_OUT_BUF)
+        _OUT_BUF.clear()
+        buffer = getattr(stdout, "buffer", None)
+        if buffer is None:
+            stdout.write(data.decode(_ENCODING, _ERRORS).replace(os.linesep, "\n"))
+        else:
+            stdout.flush()
+            buffer.write(data)
+    stdout.flush()
 
 def error(message, line_num=None):
+    # Output a memoized call had written so far still comes before the message
+    _OUT_BUF.extend(_CAPTURE)
+    _CAPTURE.clear()
+    _flush()
     loc = f" (Ln {line_num})" if line_num else ""
     print(f"\n\033[91m\u274c Error: {message}{loc}\033[0m\n")
     sys.exit(1)
 
-def resolve_value(token, input_val, line_num):
-    token = token.strip()
-    if not token: return ""
-    
-    if (token.startswith('"') and token.endswith('"')) or (token.startswith("'") and token.endswith("'")):
-        return token[1:-1]
-    
-    if token == "%1": return str(input_val)
-    
-    # Handle %var Name or %varName 
-    if token.startswith("%var"):
-        vname = token[4:].strip()
-        if vname in variables:
-            return str(variables[vname]["value"])
-        error(f"Undefined variable: {vname}", line_num)
-
-    if token in variables:
-        return str(variables[token]["value"])
-
-    return token
-
-def evaluate_condition(line, input_val, line_num):
-    # Prioritizes 2-char operators to prevent "7.5 > = 10" errors [cite: 3]
-    match = re.match(r"%if\s+(.+?)\s*(>=|<=|X=|=|>|<)\s*(.+)", line)
-    if not match: error("Invalid condition syntax", line_num)
-    
-    lhs, op, rhs = match.groups()
-    v1 = resolve_value(lhs, input_val, line_num)
-    v2 = resolve_value(rhs, input_val, line_num)
+# %if operators -> comparison function, looked up once when the condition is compiled
+_COMPARE = {"=": operator.eq, "X=": operator.ne, ">": operator.gt, "<": operator.lt,
+            ">=": operator.ge, "<=": operator.le}
+
+# Every string float() accepts ends in a digit, "." or the last letter of inf/infinity/nan
+_NUM_TAIL = frozenset("0123456789.fFyYnN")
 
+def _number(text):
+    # float(text), or None if it isn't a number; most words are turned away before float() raises
+    text = text.rstrip()
+    if not text or (text[-1] not in _NUM_TAIL and not text[-1].isdigit()): return None
     try:
-        n1, n2 = float(v1), float(v2)
-        ops = {"=": n1==n2, "X=": n1!=n2, ">": n1>n2, "<": n1<n2, ">=": n1>=n2, "<=": n1<=n2}
-        return ops[op]
+        return float(text)
     except ValueError:
-        if op == "=": return str(v1) == str(v2)
-        if op == "X=": return str(v1) != str(v2)
-    
-    error(f"Invalid comparison: {v1} {op} {v2}", line_num)
-
-def get_indent(line):
-    return len(line) - len(line.lstrip())
-
-def execute_block(lines, start_idx, input_val):
-    i = start_idx
-    if i >= len(lines): return i, input_val
-    base_indent = get_indent(lines[i][1])
-    
-    while i < len(lines):
-        ln, content = lines[i]
-        current_indent = get_indent(content)
-        if not content.strip(): 
+        return None
+
+# Hot helpers take the module objects they use as defaults so they are locals; the
+# lists and the buffer are only ever changed in place, so the bindings stay valid.
+def _resolve_operand(operand, input_val, line_num, var_text=_var_text):
+    kind, payload, slot = operand
+    if kind == KIND_LITERAL: return payload
+    if kind == KIND_INPUT: return input_val
+    text = var_text[slot]
+    if text is None:
+        if kind == KIND_VAR: error(f"Undefined variable: {payload}", line_num)
+        return payload
+    return text
+
+def _operand_number(operand, input_val, line_num, var_values=_var_values,
+                    number=_number, resolve=_resolve_operand):
+    # The operand as a float, or None; %int/%dec variables are used as stored rather
+    # than going through their text (float() of either gives the same result)
+    if operand[0] in (KIND_VAR, KIND_NAME):
+        value = var_values[operand[2]]
+        if value.__class__ is float: return value
+        if value.__class__ is int: return float(value)
+    return number(resolve(operand, input_val, line_num))
+
+def _compile_condition(lhs, op, rhs):
+    # Builds the test for one %if: a numeric compare when both sides are numbers, else
+    # = / X= on the text. The comparison and the numbers of literal sides are fixed now.
+    compare = _COMPARE[op]
+    text_compare = compare if op in ("=", "X=") else None
+    lhs_const = lhs[0] == KIND_LITERAL
+    rhs_const = rhs[0] == KIND_LITERAL
+    lhs_number = _number(lhs[1]) if lhs_const else None
+    rhs_number = _number(rhs[1]) if rhs_const else None
+
+    def test(input_val, line_num):
+        n1 = lhs_number if lhs_const else _operand_number(lhs, input_val, line_num)
+        if n1 is not None:
+            n2 = rhs_number if rhs_const else _operand_number(rhs, input_val, line_num)
+            if n2 is not None: return compare(n1, n2)
+        v1 = _resolve_operand(lhs, input_val, line_num)
+        v2 = _resolve_operand(rhs, input_val, line_num)
+        if text_compare is None: error(f"Invalid comparison: {v1} {op} {v2}", line_num)
+        return text_compare(v1, v2)
+    return test
+
+_MAX_CALL_DEPTH = 1000
+
+def run_code(code, input_val, handlers=None):
+    # The VM loop over packed code (see _pack); %if/%else are already jumps. Calls
+    # that have to run push the caller's (code, resume pc, %1) instead of recursing.
+    # Globals used on every step are bound to locals once (they are only ever updated
+    # in place, never rebound)
+    if handlers is None: handlers = HANDLERS
+    jump_if_false, jump, call = OP_JMP_IF_FALSE, OP_JMP, OP_CALL
+    frames = []
+    opcodes, ops, lines = code
+    pc = 0
+    n = len(opcodes)
+    while True:
+        if pc >= n:
+            if not frames: return input_val
+            # A call runs with the caller's %1 but doesn't hand its own back
+            code, pc, input_val = frames.pop()
+            opcodes, ops, lines = code
+            n = len(opcodes)
+            continue
+        kind = opcodes[pc]
+        if kind == jump_if_false:
+            op = ops[pc]
+            pc = pc + 1 if op[2](input_val, lines[pc]) else op[1]
+        elif kind == jump:
+            pc = ops[pc][1]
+        elif kind == call and ops[pc][2] is not None:
+            op = ops[pc]
+            if len(frames) >= _MAX_CALL_DEPTH: error(f"Too many nested calls to {op[1]}", lines[pc])
+            frames.append((code, pc + 1, input_val))
+            code = op[2]
+            opcodes, ops, lines = code
+            pc = 0
+            n = len(opcodes)
+        else:
+            input_val = handlers[kind](ops[pc], lines[pc], input_val)
+            pc += 1
+
+# --- Compilation: each source line is parsed once into an op tuple ---
+
+def _slot(name):
+    idx = _var_index.get(name)
+    if idx is None:
+        idx = _var_index[name] = len(_var_values)
+        _var_values.append(_UNDECLARED)
+        _var_types.append(None)
+        _var_text.append(None)
+    return idx
+
+def _var_token(kind, name):
+    name = sys.intern(name)
+    return (kind, name, _slot(name))
+
+# write tokens are (kind, payload, slot); slot is the variable's index, or None
+def _compile_write_token(t):
+    if t in _COLOR_NAMES: return (KIND_COLOR, COLOR_CODES[t], None)
+    if t.startswith(('"', "'")) and t.endswith(t[0]):
+        return (KIND_LITERAL, t[1:-1], None)
+    if t == "%1": return (KIND_INPUT, t, None)
+    if t.startswith("%var"): return _var_token(KIND_VAR, t[4:].strip())
+    return _var_token(KIND_NAME, t)
+
+def _compile_operand(token):
+    # A value operand: "literal", %1, %var name, or a bare word that reads the variable
+    # of that name once it is declared
+    token = token.strip()
+    if not token: return (KIND_LITERAL, "", None)
+    # Colour names only mean something to write
+    if token in _COLOR_NAMES: return _var_token(KIND_NAME, token)
+    return _compile_write_token(token)
+
+def _tokenize_write(s, i=0):
+    # Single left-to-right scan from s[i:], equivalent to %var\s*\w+ | "[^"]*" | \S+ [cite: 3]
+    tokens = []
+    n = len(s)
+    while i < n:
+        c = s[i]
+        if c.isspace():
             i += 1
             continue
-        if current_indent < base_indent: break
-
-        stripped = content.strip()
-        if stripped.startswith("%if"):
-            i, input_val = handle_if_else(lines, i, input_val)
+        if s.startswith("%var", i):
+            j = i + 4
+            while j < n and s[j].isspace(): j += 1
+            k = j
+            while k < n and (s[k].isalnum() or s[k] == "_"): k += 1
+            if k > j:
+                tokens.append(_var_token(KIND_VAR, s[j:k]))
+                i = k
+                continue
+        elif c == '"':
+            j = s.find('"', i + 1)
+            if j != -1:
+                tokens.append((KIND_LITERAL, s[i+1:j], None))
+                i = j + 1
+                continue
+        j = i + 1
+        while j < n and not s[j].isspace(): j += 1
+        tokens.append(_compile_write_token(s[i:j]))
+        i = j
+    return tokens
+
+def _compile_cls(line, line_num):
+    return (OP_CLS,)
+
+def _compile_newestvar(line, line_num):
+    parts = line.split("=")
+    if len(parts) < 2: return (OP_ERROR, "Bad variable declaration")
+    vname = sys.intern(parts[1].strip())
+    return (OP_DECL_VAR, vname, _slot(vname))
+
+def _compile_icq(line, line_num):
+    m = _RE_QUOTED.search(line)
+    if not m: return (OP_ERROR, "Bad %icq syntax")
+    return (OP_ICQ, m.group(1))
+
+def _compile_write(line, line_num):
+    # Runs of literals and colours are merged into one KIND_LITERAL holding the exact
+    # output text (colours print as-is, other tokens are followed by a space), and the
+    # line's closing reset is folded into the last run.
+    tokens = []
+    text = []
+    for kind, payload, slot in _tokenize_write(line, 5):
+        if kind == KIND_COLOR: text.append(payload)
+        elif kind == KIND_LITERAL: text.append(payload + " ")
         else:
-            input_val = execute_line(stripped, ln, input_val)
+            if text:
+                tokens.append((KIND_LITERAL, _encode("".join(text)), None))
+                text = []
+            tokens.append((kind, payload, slot))
+    text.append(_RESET_NL)
+    # Only literals and colours: the whole output line is known now
+    if not tokens: return (OP_WRITE_CONST, _encode("".join(text)))
+    tokens.append((KIND_LITERAL, _encode("".join(text)), None))
+    return (OP_WRITE, tokens)
+
+def _compile_send(line, line_num):
+    return (OP_SEND_NL,)
+
+def _compile_wait(line, line_num):
+    parts = line.split()
+    if len(parts) < 2: return (OP_ERROR, "Bad wait syntax")
+    return (OP_WAIT, _compile_operand(parts[1]))
+
+def _compile_msg(line, line_num):
+    m = _RE_MSG.search(line)
+    return (OP_MSG, m.group(1), _compile_operand(m.group(2))) if m else (OP_NOP,)
+
+# Commands that must be the whole line, and commands recognised by their leading
+# keyword alone (so `write"hi"` and `%icq"Name?"` work), in the order they are tried
+_EXACT = {
+    "%cls": _compile_cls,
+    "send %NL%": _compile_send,
+}
+_PREFIXED = (
+    ("%newestvar", _compile_newestvar),
+    ("%icq", _compile_icq),
+    ("write", _compile_write),
+    ("wait", _compile_wait),
+    ("msg", _compile_msg),
+)
+_KEYWORDS = tuple(keyword for keyword, _ in _PREFIXED)
+
+def _is_word(s):
+    # Non-empty and only word characters, like \w+
+    return s.replace("_", "a").isalnum()
+
+def compile_line(line, line_num):
+    # A line that can't be parsed compiles to OP_ERROR, which only reports it if it runs
+    if line.startswith("%if"):
+        # Prioritizes 2-char operators to prevent "7.5 > = 10" errors [cite: 3]
+        m = _RE_IF.match(line)
+        if not m: return (OP_ERROR, "Invalid condition syntax")
+        lhs, cmp, rhs = m.groups()
+        lhs, rhs = _compile_operand(lhs), _compile_operand(rhs)
+        return (OP_IF, _compile_condition(lhs, cmp, rhs), lhs, rhs)
+    if line == "%else": return (OP_ELSE,)
+
+    compiler = _EXACT.get(line)
+    if compiler: return compiler(line, line_num)
+
+    lhs, eq, rhs = line.partition("=")
+    if eq:
+        lhs = lhs.rstrip()
+        rhs = rhs.lstrip()
+        # Assignment: name%value = value [cite: 1]
+        if lhs.endswith("%value"):
+            vname = lhs[:-6]
+            if rhs and _is_word(vname):
+                vname = sys.intern(vname)
+                return (OP_SET_VAR, vname, _slot(vname), _compile_operand(rhs))
+
+        # Typing: name = %type (the type only has to prefix the value) [cite: 1, 2]
+        elif _is_word(lhs):
+            for vtype in _VAR_TYPES:
+                if rhs.startswith(vtype):
+                    vname = sys.intern(lhs)
+                    return (OP_TYPE_VAR, vname, _slot(vname), vtype)
+
+    if line.startswith(_KEYWORDS):
+        compiler = next(c for keyword, c in _PREFIXED if line.startswith(keyword))
+        return compiler(line, line_num)
+
+    if line in functions: return (OP_CALL, line)
+    if line == _END_TOKEN: return (OP_END,)
+    return (OP_NOP,)
+
+def _patch_jump(code, pc):
+    # Points the jump at code[pc] to the next op to be emitted
+    ln, op = code[pc]
+    code[pc] = (ln, (op[0], len(code)) + op[2:])
+
+def _keep_input(code, start, ln):
+    # %icq inside an %if/%else body doesn't change %1 for the code after it, so a
+    # construct that prompts saves %1 before and restores it after; the jumps in it
+    # move up one place to make room
+    for pc in range(start, len(code)):
+        line, op = code[pc]
+        if op[0] in (OP_JMP_IF_FALSE, OP_JMP): code[pc] = (line, (op[0], op[1] + 1) + op[2:])
+    code.insert(start, (ln, (OP_PUSH_INPUT,)))
+    code.append((ln, (OP_POP_INPUT,)))
+
+def _dedent_table(lines):
+    # For each line, the index of the first later line indented less than it (or the
+    # line count): where a block starting on that line ends. One pass with a stack of
+    # lines still waiting for their dedent.
+    ends = [len(lines)] * len(lines)
+    waiting = []
+    for i, (_, indent, _) in enumerate(lines):
+        while waiting and lines[waiting[-1]][1] > indent:
+            ends[waiting.pop()] = i
+        waiting.append(i)
+    return ends
+
+def _compiled(lines, ops, i):
+    # Lines are compiled when the lowering first reaches them
+    op = ops[i]
+    if op is None:
+        ln, _, stripped = lines[i]
+        op = ops[i] = compile_line(stripped, ln)
+    return op
+
+def _lower_block(lines, ops, ends, i, code):
+    # Appends the flat ops of the block that starts at lines[i], turning %if/%else into
+    # jumps. Blocks follow the indentation rules of the old execute_block/handle_if_else:
+    # a block runs until the first line indented less than its first line; an %if's body
+    # is the block on the next line, and an %else on the line where that body ends (at
+    # any indent) starts its else body; the block then carries on after the else body.
+    n = len(lines)
+    if i >= n: return
+    base_indent = lines[i][1]
+    while i < n and lines[i][1] >= base_indent:
+        ln = lines[i][0]
+        op = _compiled(lines, ops, i)
+        if op[0] != OP_IF:
+            # Unknown lines and stray %else lines only mattered for their indentation
+            if op[0] not in (OP_NOP, OP_ELSE): code.append((ln, op))
+            # Nothing after an exit or an error in the same block can run
+            if op[0] in (OP_END, OP_ERROR): return
             i += 1
-    return i, input_val
-
-def handle_if_else(lines, idx, input_val):
-    ln, content = lines[idx]
-    condition_met = evaluate_condition(content.strip(), input_val, ln)
-    
-    if_start = idx + 1
-    if_end = if_start
-    if if_start < len(lines):
-        target_indent = get_indent(lines[if_start][1])
-        while if_end < len(lines) and (not lines[if_end][1].strip() or get_indent(lines[if_end][1]) >= target_indent):
-            if_end += 1
-
-    else_start = -1
-    else_end = -1
-    if if_end < len(lines) and lines[if_end][1].strip() == "%else":
-        else_start = if_end + 1
-        else_end = else_start
-        if else_start < len(lines):
-            target_indent = get_indent(lines[else_start][1])
-            while else_end < len(lines) and (not lines[else_end][1].strip() or get_indent(lines[else_end][1]) >= target_indent):
-                else_end += 1
-
-    if condition_met:
-        execute_block(lines, if_start, input_val)
-    elif else_start != -1:
-        execute_block(lines, else_start, input_val)
-
-    return (else_end if else_end != -1 else if_end), input_val
-
-def execute_line(line, line_num, input_val):
-    global variables
-    
-    # 1. NEW: Clear Screen Command [cite: 1]
-    if line == "%cls":
-        clear_console()
-        return input_val
-
-    # 2. Assignment [cite: 1]
-    m_val = re.match(r"(\w+)%value\s*=\s*(.+)", line)
-    if m_val:
-        vname, raw_val = m_val.groups()
-        if vname not in variables: error(f"Variable '{vname}' not declared", line_num)
-        final_val = resolve_value(raw_val, input_val, line_num)
-        v_type = variables[vname]["type"]
-        try:
-            if v_type == "%int": variables[vname]["value"] = int(float(final_val))
-            elif v_type == "%dec": variables[vname]["value"] = float(final_val)
-            else: variables[vname]["value"] = str(final_val)
-        except:
-            variables[vname]["value"] = final_val
-        return input_val
-
-    # 3. Declarations [cite: 1, 2]
-    if line.startswith("%newestvar"):
-        vname = line.split("=")[1].strip()
-        variables[vname] = {"type": None, "value": None}
-        return input_val
-    
-    m_type = re.match(r"(\w+)\s*=\s*(%int|%dec|%txt|%string)", line)
-    if m_type:
-        vname, vtype = m_type.groups()
-        if vname in variables: variables[vname]["type"] = vtype
-        return input_val
-
-    # 4. Input & Write [cite: 1, 2]
-    if line.startswith("%icq"):
-        prompt = re.search(r'"([^"]*)"', line).group(1)
-        return input(prompt + " ")
-
-    if line.startswith("write"):
-        content = line[5:].strip()
-        # Better tokenizing to separate %var and strings [cite: 3]
-        tokens = re.findall(r'%var\s*\w+|"[^"]*"|\S+', content)
-        for t in tokens:
-            if t in COLOR_CODES: 
-                print(COLOR_CODES[t], end="")
-            else: 
-                print(resolve_value(t, input_val, line_num), end=" ")
-        print(COLOR_CODES["%normal"])
-        return input_val
-
-    if line == "send %NL%":
-        print()
-        return input_val
-
-    if line.startswith("wait"):
-        time.sleep(float(resolve_value(line.split()[1], input_val, line_num)))
-        return input_val
-
-    if line.startswith("msg"):
-        if HAVE_TOAST:
-            m = re.search(r'%title\s+"([^"]+)"\s+%subtitle\s+(.+)', line)
-            if m:
-                title, sub = m.groups()
-                toast_fn(title, resolve_value(sub, input_val, line_num))
-        return input_val
-
-    if line in functions:
-        execute_block(functions[line], 0, input_val)
-        return input_val
-
-    if line == "einid cimidisiciriiipit": sys.exit(0)
+            continue
+
+        start = len(code)
+        code.append((ln, (OP_JMP_IF_FALSE, None) + op[1:]))
+        _lower_block(lines, ops, ends, i + 1, code)
+        i = ends[i + 1] if i + 1 < n else n
+        if i < n and _compiled(lines, ops, i)[0] == OP_ELSE:
+            skip = len(code)
+            code.append((lines[i][0], (OP_JMP, None)))
+            _patch_jump(code, start)
+            _lower_block(lines, ops, ends, i + 1, code)
+            _patch_jump(code, skip)
+            i = ends[i + 1] if i + 1 < n else n
+        else:
+            _patch_jump(code, start)
+        if any(op[0] == OP_ICQ for _, op in code[start:]): _keep_input(code, start, ln)
+
+def compile_block(lines):
+    # Lines are compiled as the lowering reaches them, so nothing after an exit in
+    # the same block is compiled at all
+    code = []
+    _lower_block(lines, [None] * len(lines), _dedent_table(lines), 0, code)
+    return code
+
+def _constant_output(code):
+    # Output of a body made only of constant writes, or None if it depends on runtime state
+    parts = []
+    for _, op in code:
+        if op[0] == OP_SEND_NL: parts.append(_NEWLINE)
+        elif op[0] == OP_WRITE_CONST: parts.append(op[1])
+        else: return None
+    return b"".join(parts)
+
+def _find_pure(functions):
+    # Functions that only write, branch and call other such functions can't change
+    # any state, so their output is fixed by %1 and the variables they read
+    found = {}
+    for name, code in functions.items():
+        slots, callees = set(), set()
+        for ln, op in code:
+            kind = op[0]
+            if kind == OP_WRITE: slots.update(t[2] for t in op[1] if t[2] is not None)
+            elif kind == OP_JMP_IF_FALSE: slots.update((op[3][2], op[4][2]))
+            elif kind == OP_CALL: callees.add(op[1])
+            elif kind not in (OP_WRITE_CONST, OP_SEND_NL, OP_JMP): break
+        else:
+            slots.discard(None)
+            found[name] = (slots, callees)
+    # A function that can reach itself is never memoized: with no state to change,
+    # such a pure function can only recurse forever. run_code enters it instead,
+    # like any other call.
+    for name in list(found):
+        seen, todo = set(), list(found[name][1])
+        while todo:
+            callee = todo.pop()
+            if callee in seen or callee not in found: continue
+            seen.add(callee)
+            todo.extend(found[callee][1])
+        if name in seen: del found[name]
+    # Drop callers of impure functions and add callees' reads, until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for name, (slots, callees) in list(found.items()):
+            if not callees <= found.keys():
+                del found[name]
+                changed = True
+                continue
+            for callee in callees:
+                if not found[callee][0] <= slots:
+                    slots |= found[callee][0]
+                    changed = True
+    return {name: tuple(sorted(slots)) for name, (slots, callees) in found.items()}
+
+def _pack(code):
+    # Splits a list of (line, op) into parallel arrays: opcodes, op tuples and line
+    # numbers, so the VM's dispatch reads only the compact opcode array
+    return (array("B", [op[0] for _, op in code]), [op for _, op in code],
+            array("I", [ln for ln, _ in code]))
+
+def _link_calls(code, functions, pure):
+    # Calls that run the callee's body get its packed code, so the VM enters it without
+    # any lookups; calls with constant or memoized output keep None and use _run_call
+    ops = code[1]
+    for pc, op in enumerate(ops):
+        if op[0] == OP_CALL:
+            name = op[1]
+            body = None if name in _function_output or name in pure else functions[name]
+            ops[pc] = (OP_CALL, name, body)
+
+# --- Runtime handlers, indexed by opcode ---
+
+def _run_write(op, line_num, input_val, out=_OUT_BUF, var_text=_var_text):
+    # The encoding and separator depend on stdout, so they are read when the op runs
+    encoding, errors, space = _ENCODING, _ERRORS, _SPACE
+    for kind, payload, slot in op[1]:
+        if kind == KIND_LITERAL:
+            out.append(payload)
+            continue
+        if kind == KIND_INPUT: text = input_val
+        else:
+            text = var_text[slot]
+            if text is None:
+                if kind == KIND_VAR: error(f"Undefined variable: {payload}", line_num)
+                text = payload
+        out.append(text.encode(encoding, errors))
+        out.append(space)
+    if len(out) >= _FLUSH_AT: _flush()
     return input_val
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("script")
-    args = parser.parse_args()
+def _run_write_const(op, line_num, input_val, out=_OUT_BUF):
+    out.append(op[1])
+    if len(out) >= _FLUSH_AT: _flush()
+    return input_val
 
-    with open(args.script, "r", encoding="utf-8") as f:
-        lines = [(i+1, l.rstrip()) for i, l in enumerate(f.readlines()) if l.strip() and not l.strip().startswith("#")]
+def _run_wait(op, line_num, input_val, sleep=time.sleep, resolve=_resolve_operand):
+    _flush()
+    sleep(float(resolve(op[1], input_val, line_num)))
+    return input_val
 
-    main_body = []
-    i = 0
-    while i < len(lines):
-        ln, content = lines[i]
-        if content.strip().startswith("%f"):
-            fname = content.strip()[2:].rstrip(":").strip()
-            functions[fname] = []
-            i += 1
-            while i < len(lines) and (get_indent(lines[i][1]) > 0 or not lines[i][1].strip()):
-                functions[fname].append(lines[i])
-                i += 1
-        else:
-            main_body.append(lines[i])
-            i += 1
+def _run_msg(op, line_num, input_val):
+    toast = _get_toast()
+    if toast: toast(op[1], _resolve_operand(op[2], input_val, line_num))
+    return input_val
+
+def _run_send_nl(op, line_num, input_val, out=_OUT_BUF):
+    out.append(_NEWLINE)
+    if len(out) >= _FLUSH_AT: _flush()
+    return input_val
+
+def _run_set_var(op, line_num, input_val):
+    idx = op[2]
+    if _var_values[idx] is _UNDECLARED: error(f"Variable '{op[1]}' not declared", line_num)
+    final_val = _resolve_operand(op[3], input_val, line_num)
+    v_type = _var_types[idx]
+    try:
+        if v_type == "%int": value = int(float(final_val))
+        elif v_type == "%dec": value = float(final_val)
+        else: value = final_val
+    except:
+        value = final_val
+    _var_values[idx] = value
+    _var_text[idx] = value if value.__class__ is str else str(value)
+    return input_val
+
+def _run_decl_var(op, line_num, input_val):
+    _var_types[op[2]] = None
+    _var_values[op[2]] = None
+    _var_text[op[2]] = "None"
+    return input_val
+
+def _run_type_var(op, line_num, input_val):
+    if _var_values[op[2]] is not _UNDECLARED: _var_types[op[2]] = op[3]
+    return input_val
+
+def _run_icq(op, line_num, input_val):
+    _flush()
+    return input(op[1] + " ")
+
+def _run_call(op, line_num, input_val, out=_OUT_BUF):
+    # Only calls whose output is known or memoized get here; run_code enters the rest
+    text = _function_output.get(op[1])
+    if text is None:
+        # Scripts only ever see variables as text, so that is all the key needs
+        key = tuple([_var_text[s] for s in _pure_reads[op[1]]])
+        text = _pure_output(op[1], input_val, key)
+    out.append(text)
+    if len(out) >= _FLUSH_AT: _flush()
+    return input_val
 
-    execute_block(main_body, 0, "")
+@functools.lru_cache(maxsize=1024)
+def _pure_output(name, input_val, key):
+    # Runs a pure function once per (%1, values it reads) and keeps what it wrote.
+    # Its output goes to _CAPTURE, so it is held back until the call finishes.
+    mark = len(_CAPTURE)
+    try:
+        run_code(functions[name], input_val, _CAPTURE_HANDLERS)
+    except BaseException:
+        # Interrupted: what was written so far is still output, in order
+        _OUT_BUF.extend(_CAPTURE)
+        _CAPTURE.clear()
+        raise
+    text = b"".join(_CAPTURE[mark:])
+    del _CAPTURE[mark:]
+    return text
+
+def _run_end(op, line_num, input_val):
+    _flush()
+    sys.exit(0)
+
+def _run_cls(op, line_num, input_val):
+    clear_console()
+    return input_val
+
+def _run_error(op, line_num, input_val):
+    # A line that couldn't be parsed only fails once it is reached
+    error(op[1], line_num)
+
+def _run_push_input(op, line_num, input_val):
+    _SAVED_INPUT.append(input_val)
+    return input_val
+
+def _run_pop_input(op, line_num, input_val):
+    return _SAVED_INPUT.pop()
+
+# Jumps are handled inline by run_code; OP_IF/OP_ELSE/OP_NOP never reach it
+HANDLERS = [_run_write, _run_wait, _run_msg, _run_send_nl, _run_set_var, _run_decl_var, _run_type_var,
+            _run_icq, _run_call, _run_end, _run_cls, None, None, None, _run_error, _run_write_const,
+            None, None, _run_push_input, _run_pop_input]
+
+# Memoized functions only write, branch and make calls, so only those handlers differ
+_CAPTURE_HANDLERS = list(HANDLERS)
+for _kind, _handler in ((OP_WRITE, _run_write), (OP_WRITE_CONST, _run_write_const),
+                        (OP_SEND_NL, _run_send_nl), (OP_CALL, _run_call)):
+    _CAPTURE_HANDLERS[_kind] = functools.partial(_handler, out=_CAPTURE)
+
+def _source_lines(f):
+    # Yields each kept line as (line number, indent, stripped text). The left strip
+    # gives both the indent and the text, so each side is only stripped once.
+    for i, l in enumerate(f, 1):
+        body = l.lstrip()
+        if body and body[0] != "#":
+            yield (i, len(l) - len(body), body.rstrip())
+
+_PARSED_CACHE = {}  # (path, mtime_ns, encoding, errors) -> (main program, functions, _function_output, _pure_reads)
+
+def load_script(path):
+    # Compiles a script file, reusing the result while the file is unchanged
+    # Constant text is compiled to bytes, so the output encoding is part of the key
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns, _ENCODING, _ERRORS)
+    cached = _PARSED_CACHE.get(key)
+    if cached is not None: return cached
+
+    functions.clear()
+    _function_output.clear()
+    main_body = []
+    # Lines stream straight from the file into the body they belong to; a function
+    # body is the run of indented lines after its %f header
+    body = main_body
+    with open(path, "r", encoding="utf-8", buffering=1 << 16) as f:
+        for line in _source_lines(f):
+            if body is not main_body and line[1] > 0:
+                body.append(line)
+            elif line[2].startswith("%f"):
+                body = functions[line[2][2:].rstrip(":").strip()] = []
+            else:
+                body = main_body
+                body.append(line)
+
+    # Function names must all be known before compiling, so calls can be resolved
+    for fname in functions:
+        functions[fname] = compile_block(functions[fname])
+        text = _constant_output(functions[fname])
+        if text is not None: _function_output[fname] = text
+
+    pure = _find_pure(functions)
+    main = _pack(compile_block(main_body))
+    for fname in functions:
+        functions[fname] = _pack(functions[fname])
+    for code in [main, *functions.values()]:
+        _link_calls(code, functions, pure)
+    cached = _PARSED_CACHE[key] = (main, dict(functions), dict(_function_output), pure)
+    return cached
+
+def run(path):
+    _bind_stdout()
+    prog, funcs, outputs, pure = load_script(path)
+    functions.clear()
+    functions.update(funcs)
+    _function_output.clear()
+    _function_output.update(outputs)
+    _pure_reads.clear()
+    _pure_reads.update(pure)
+    _pure_output.cache_clear()
+    # Every run starts with no variables declared
+    _var_values[:] = [_UNDECLARED] * len(_var_values)
+    _var_types[:] = [None] * len(_var_types)
+    _var_text[:] = [None] * len(_var_text)
+    _SAVED_INPUT.clear()
+
+    _enable_vt()
+    try:
+        run_code(prog, "")
+    finally:
+        _flush()
     print("\n✔ Script finished.")
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script")
+    args = parser.parse_args()
+    run(args.script)
+
 if __name__ == "__main__":
     main()